@@ -7,13 +7,24 @@
 ##
 
 import sys
+import time
 import os.path
 import pygame
 import socket
+import threading
+import itertools
 try:
     from urllib import urlopen
 except ImportError:
     from urllib.request import urlopen
+try:
+    import evdev
+except ImportError:
+    evdev = None
+try:
+    from pygame._sdl2 import audio as sdl2audio
+except ImportError:
+    sdl2audio = None
 
     
 def get_server_addr():
@@ -73,6 +84,72 @@ KEYCODE2SYM.update({
     (13,): 'ENTER',
 })
 
+# evdev seats never send NumLock (300): bare keypad codes only,
+# so only '0' vs '00' is ambiguous.
+EVDEV_KEYCODE2SYM = dict( (keys,sym) for (keys,sym) in KEYCODE2SYM.items()
+                          if 300 not in keys )
+EVDEV_KEYCODE2SYM.update({
+    (256,256): '00',
+    (256,): '0',
+    (257,): '1',
+    (258,): '2',
+    (259,): '3',
+    (260,): '4',
+    (261,): '5',
+    (262,): '6',
+    (263,): '7',
+    (264,): '8',
+    (265,): '9',
+    (266,): '.',
+    (267,): '/',
+    (268,): '*',
+    (269,): '-',
+    (270,): '+',
+    (271,): 'ENTER',
+})
+
+# evdev key names -> Pygame key codes (for multi-seat input)
+EVDEV2KEYCODE = {
+    'KEY_KP0': 256,
+    'KEY_KP1': 257,
+    'KEY_KP2': 258,
+    'KEY_KP3': 259,
+    'KEY_KP4': 260,
+    'KEY_KP5': 261,
+    'KEY_KP6': 262,
+    'KEY_KP7': 263,
+    'KEY_KP8': 264,
+    'KEY_KP9': 265,
+    'KEY_KPDOT': 266,
+    'KEY_KPSLASH': 267,
+    'KEY_KPASTERISK': 268,
+    'KEY_KPMINUS': 269,
+    'KEY_KPPLUS': 270,
+    'KEY_KPENTER': 271,
+    'KEY_BACKSPACE': 8,
+    'KEY_TAB': 9,
+}
+
+MAX_SEATS = 4
+
+# posted by the evdev reader threads: .seat, .key
+SEATEVENT = pygame.USEREVENT+1
+# fires when a pending chord times out.
+CHORDEVENT = pygame.USEREVENT+2
+
+# msec to wait for a longer chord, by sys.platform prefix (-t overrides).
+CHORD_TIMEOUT = (
+    ('linux', 50),   # Raspberry Pi: NumLock chords
+    ('win', 30),
+    ('darwin', 30),
+)
+
+def get_chord_timeout(platform=sys.platform):
+    for (prefix, timeout) in CHORD_TIMEOUT:
+        if platform.startswith(prefix):
+            return timeout
+    return 50
+
 SYM2POS = {
     'TAB': (0,0),
     '/': (1,0),
@@ -138,6 +215,9 @@ CMD2SOUND = {
     'B2': 'cmd_branch2',
 }
 
+# loaded by main() until the first level is polled (pybotstats.py skips it).
+PLACEHOLDER_BOARD = '@#./.../#=!/..%/E..'
+
 SND_OK = 'snd_ok'
 SND_NG = 'snd_ng'
 SOUNDS = (
@@ -194,21 +274,202 @@ SOUNDS = (
     'num_20',
 )
 
+class ChordDecoder:
+
+    """Turns key codes into symbols as soon as the chord is unambiguous.
+
+    Keys of a chord may arrive in any order, so the trie is keyed
+    by sorted key tuples: every sub-chord of a KEYCODE2SYM entry is a
+    node. A complete chord is dispatched at once unless a longer
+    chord is still possible, in which case it waits for the timeout.
+    """
+
+    def __init__(self, keymap=KEYCODE2SYM, timeout=50):
+        self.timeout = timeout
+        self._nodes = {}
+        self._longer = set()
+        for (keys, sym) in keymap.items():
+            keys = tuple(sorted(keys))
+            for n in range(1, len(keys)):
+                for sub in itertools.combinations(keys, n):
+                    self._nodes.setdefault(sub, None)
+                    self._longer.add(sub)
+            self._nodes[keys] = sym
+        self._keys = ()
+        self._t0 = 0
+        return
+
+    def pending(self):
+        return bool(self._keys)
+
+    def remaining(self, t):
+        return max(1, self._t0+self.timeout-t)
+
+    def push(self, key, t):
+        """Adds a key and returns the symbols decoded."""
+        syms = []
+        keys = tuple(sorted(self._keys+(key,)))
+        if keys not in self._nodes:
+            # no chord goes this way: end the pending one here.
+            sym = self._nodes.get(self._keys)
+            if sym is not None:
+                syms.append(sym)
+            keys = (key,)
+            if keys not in self._nodes:
+                self._keys = ()
+                return syms
+        sym = self._nodes[keys]
+        if sym is not None and keys not in self._longer:
+            syms.append(sym)
+            self._keys = ()
+        else:
+            self._keys = keys
+            self._t0 = t
+        return syms
+
+    def poll(self, t):
+        """Returns the symbols whose chords have timed out."""
+        if not self._keys or t < self._t0+self.timeout: return []
+        sym = self._nodes.get(self._keys)
+        self._keys = ()
+        if sym is None: return []
+        return [sym]
+
+
+class Shared:
+
+    """Resources shared between all the sessions in one process."""
+
+    def __init__(self, font, sounds):
+        self.font = font
+        self.sounds = sounds
+        self.glyphs = {}
+        self.raws = {}
+        self.levels = {}
+        self.boards = {}
+        return
+
+    def render(self, s, highlight=False):
+        k = (s, highlight)
+        try:
+            return self.glyphs[k]
+        except KeyError:
+            if highlight:
+                b = self.font.render(s, 0, BGCOLOR, FGCOLOR)
+            else:
+                b = self.font.render(s, 0, FGCOLOR, BGCOLOR)
+            self.glyphs[k] = b
+            return b
+
+    def getRaw(self, sound):
+        try:
+            return self.raws[sound]
+        except KeyError:
+            data = self.raws[sound] = sound.get_raw()
+            return data
+
+    def parseLevel(self, data):
+        try:
+            return self.levels[data]
+        except KeyError:
+            level = self.levels[data] = eval(data.strip())
+            return level
+
+    def parseBoard(self, data):
+        try:
+            return self.boards[data]
+        except KeyError:
+            pass
+        board = {}
+        startpos = None
+        startdir = None
+        for (y,row) in enumerate(data.split('/')):
+            for (x,c) in enumerate(row):
+                if c == ' ': continue
+                if c in TILE2DIR:
+                    startpos = (x,y)
+                    startdir = TILE2DIR[c]
+                    c = '.'
+                board[(x,y)] = c
+        assert startpos is not None
+        assert startdir is not None
+        self.boards[data] = (board, startpos, startdir)
+        return (board, startpos, startdir)
+
+
+class SeatOutput:
+
+    """Plays the sounds of one seat on its own audio device.
+    Works like the parts of pygame.mixer.Channel that App uses."""
+
+    def __init__(self, shared, devicename):
+        (frequency, size, channels) = pygame.mixer.get_init()
+        # same sample format as the mixer, so raw sounds play as is.
+        if sys.byteorder == 'little':
+            audioformat = sdl2audio.AUDIO_S16LSB
+        else:
+            audioformat = sdl2audio.AUDIO_S16MSB
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._data = b''
+        self._pos = 0
+        self.device = sdl2audio.AudioDevice(
+            devicename=devicename, iscapture=False, frequency=frequency,
+            audioformat=audioformat, numchannels=channels, chunksize=512,
+            allowed_changes=0, callback=self._callback)
+        self.device.pause(0)
+        return
+
+    def _callback(self, device, stream):
+        # called from the audio thread.
+        n = len(stream)
+        with self._lock:
+            data = self._data[self._pos:self._pos+n]
+            self._pos += len(data)
+        stream[:len(data)] = data
+        stream[len(data):] = b'\0'*(n-len(data))
+        return
+
+    def play(self, sound):
+        data = self.shared.getRaw(sound)
+        with self._lock:
+            (self._data, self._pos) = (data, 0)
+        return
+
+    def stop(self):
+        with self._lock:
+            (self._data, self._pos) = (b'', 0)
+        return
+
+    def get_busy(self):
+        with self._lock:
+            return self._pos < len(self._data)
+
+
 class App:
 
-    def __init__(self, surface, font, sounds, baseurls):
+    def __init__(self, surface, shared, baseurls, channel,
+                 logfp=None, keymap=KEYCODE2SYM, timeout=50):
         (self.width, self.height) = surface.get_size()
         self.surface = surface
-        self.font = font
-        self.sounds = sounds
+        self.rect = pygame.Rect(surface.get_abs_offset(), surface.get_size())
+        self.shared = shared
+        self.sounds = shared.sounds
         self.baseurls = baseurls
+        self.channel = channel
+        self.logfp = logfp
         self._taskq = []
         self._data0 = None
+        self.decoder = ChordDecoder(keymap, timeout)
         self.log('App(%d,%d, baseurls=%r)' % (self.width, self.height, self.baseurls))
         return
 
     def log(self, *args):
-        print(' '.join(args))
+        msg = ' '.join(args)
+        print(msg)
+        if self.logfp is not None:
+            # session log: "time<TAB>message" (read by pybotstats.py)
+            self.logfp.write('%.3f\t%s\n' % (time.time(), msg))
         return
 
     def poll(self):
@@ -243,7 +504,7 @@ class App:
                     continue
         if self._data0 != data:
             try:
-                (board, code, codelimit, cmdlimit) = eval(data.strip())
+                (board, code, codelimit, cmdlimit) = self.shared.parseLevel(data)
             except Exception as e:
                 self.log('poll: invalid data: %r' % e)
                 return False
@@ -264,37 +525,26 @@ class App:
         return
         
     def run(self):
-        pygame.time.set_timer(pygame.USEREVENT, 33)
-        keys = []
-        t0 = 0
-        while 1:
-            e = pygame.event.wait()
-            if e.type == pygame.QUIT:
-                break
-            elif e.type == pygame.KEYDOWN:
-                if e.key in (pygame.K_q, pygame.K_ESCAPE, pygame.K_F4):
-                    break
-                else:
-                    t0 = pygame.time.get_ticks()
-                    keys.append(e.key)
-            elif e.type == pygame.VIDEOEXPOSE:
-                self.refresh()
-            elif e.type == pygame.USEREVENT:
-                t = pygame.time.get_ticks()
-                if 50 <= (t-t0):
-                    k = KEYCODE2SYM.get(tuple(sorted(keys)))
-                    keys = []
-                    if k is not None:
-                        self.keypress(k)
-                        self.refresh()
-                self.update()
+        return run([self])
+
+    def keydown(self, key):
+        for k in self.decoder.push(key, pygame.time.get_ticks()):
+            self.keypress(k)
+            self.refresh()
+        return
+
+    def flush(self):
+        for k in self.decoder.poll(pygame.time.get_ticks()):
+            self.keypress(k)
+            self.refresh()
+        return
+
+    def tick(self):
+        self.update()
         return
 
     def drawText(self, s, x, y, highlight=False):
-        if highlight:
-            b = self.font.render(s, 0, BGCOLOR, FGCOLOR)
-        else:
-            b = self.font.render(s, 0, FGCOLOR, BGCOLOR)
+        b = self.shared.render(s, highlight)
         self.surface.blit(b, (x,y))
         return
 
@@ -302,7 +552,7 @@ class App:
         if name is not None:
             self._taskq.append(self.sounds[name])
         else:
-            pygame.mixer.stop()
+            self.channel.stop()
             self._taskq = []
         return
 
@@ -312,10 +562,10 @@ class App:
 
     def update(self):
         if self._taskq:
-            if not pygame.mixer.get_busy():
+            if not self.channel.get_busy():
                 task = self._taskq.pop(0)
                 if hasattr(task, 'play'):
-                    task.play()
+                    self.channel.play(task)
                 elif callable(task):
                     task()
         else:
@@ -347,7 +597,7 @@ class App:
         elif self.mode == 'runtime':
             self.drawText('Runtime', 16, 0)
             self.drawCode(256, 80, self._runpos)
-        pygame.display.flip()
+        pygame.display.update(self.rect)
         return
 
     def initEditor(self):
@@ -419,6 +669,7 @@ class App:
                 self._running = False
             else:
                 self.resetState()
+                self.log('run: %r' % self._code)
                 self._running = True
                 self._nexttime = 0
                 self.playSound('level_begin')
@@ -467,25 +718,16 @@ class App:
         return
 
     def clearLevel(self):
+        # True: reached by the running program, False: by stepping.
+        self.log('clearLevel: %r' % self._running)
         self._running = False
         self.playSound('level_end')
         return
 
     def loadBoard(self, data):
         self.log('loadBoard: %r' % data)
-        self._board = {}
-        self._startpos = None
-        self._startdir = None
-        for (y,row) in enumerate(data.split('/')):
-            for (x,c) in enumerate(row):
-                if c == ' ': continue
-                if c in TILE2DIR:
-                    self._startpos = (x,y)
-                    self._startdir = TILE2DIR[c]
-                    c = '.'
-                self._board[(x,y)] = c
-        assert self._startpos is not None
-        assert self._startdir is not None
+        # the parsed board is shared and never modified.
+        (self._board, self._startpos, self._startdir) = self.shared.parseBoard(data)
         return
 
     def loadCode(self, code):
@@ -530,6 +772,7 @@ class App:
         elif c == '#':
             pass
         elif c == '!':
+            self.log('bomb: %r' % (pos,))
             self.resetState()
         elif c == '=':
             if self._haskey:
@@ -675,14 +918,64 @@ class App:
         pygame.draw.polygon(self.surface, FGCOLOR, pts)
         return
 
-    
+
+def run(apps, keyboard=True):
+    """Runs the sessions in one event loop.
+    The Pygame keyboard drives the first session unless keyboard
+    is False (seats with their own devices); it can still quit."""
+    def schedule():
+        # wake up when the earliest pending chord times out.
+        t = pygame.time.get_ticks()
+        waits = [ app.decoder.remaining(t) for app in apps
+                  if app.decoder.pending() ]
+        pygame.time.set_timer(CHORDEVENT, min(waits) if waits else 0)
+        return
+    pygame.time.set_timer(pygame.USEREVENT, 33)
+    while 1:
+        e = pygame.event.wait()
+        if e.type == pygame.QUIT:
+            break
+        elif e.type == pygame.KEYDOWN:
+            if e.key in (pygame.K_q, pygame.K_ESCAPE, pygame.K_F4):
+                break
+            elif keyboard:
+                apps[0].keydown(e.key)
+                schedule()
+        elif e.type == SEATEVENT:
+            apps[e.seat].keydown(e.key)
+            schedule()
+        elif e.type == CHORDEVENT:
+            for app in apps:
+                app.flush()
+            schedule()
+        elif e.type == pygame.VIDEOEXPOSE:
+            for app in apps:
+                app.refresh()
+        elif e.type == pygame.USEREVENT:
+            for app in apps:
+                app.tick()
+    return
+
+def read_seat(seat, device):
+    """Forwards the key presses of an evdev device to a seat."""
+    code2key = {}
+    for (name, key) in EVDEV2KEYCODE.items():
+        code2key[evdev.ecodes.ecodes[name]] = key
+    for e in device.read_loop():
+        # value: 0=up, 1=down, 2=repeat
+        if e.type != evdev.ecodes.EV_KEY or e.value != 1: continue
+        key = code2key.get(e.code)
+        if key is None: continue
+        pygame.event.post(pygame.event.Event(SEATEVENT, seat=seat, key=key))
+    return
+
 def main(argv):
     import getopt
     def usage():
-        print('usage: %s [-d] [-f] [-F fonts] [-S sounds] [url ...]' % argv[0])
+        print('usage: %s [-d] [-f] [-F fonts] [-S sounds] [-l logfile] [-K device -A audio ...] [-t msec] [url ...]' % argv[0])
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dfF:S:')
+        (opts, args) = getopt.getopt(argv[1:], 'dfF:S:l:K:A:t:')
     except getopt.GetoptError:
         return usage()
     debug = 0
@@ -690,18 +983,46 @@ def main(argv):
     flags = 0
     fontpath = './fonts/VeraMono.ttf'
     sounddir = './sounds/'
+    logpath = None
+    devices = []
+    outputs = []
+    timeout = get_chord_timeout()
     for (k, v) in opts:
         if k == '-d': debug += 1
         elif k == '-f': flags = pygame.FULLSCREEN
         elif k == '-F': fontpath = v
         elif k == '-S': sounddir = v
+        elif k == '-l': logpath = v
+        elif k == '-K': devices.append(v)
+        elif k == '-A': outputs.append(v)
+        elif k == '-t': timeout = int(v)
+    if MAX_SEATS < len(devices):
+        print('%s: at most %d seats (-K) are supported.' % (argv[0], MAX_SEATS))
+        return 1
+    if outputs and len(outputs) != max(1, len(devices)):
+        print('%s: give one audio output (-A) per seat (-K).' % argv[0])
+        return 1
+    if 1 < len(devices) and not outputs:
+        print('%s: each seat needs its own audio output (-A).' % argv[0])
+        return 1
+    if devices and evdev is None:
+        print('%s: -K requires evdev.' % argv[0])
+        return 1
+    if outputs and sdl2audio is None:
+        print('%s: -A requires Pygame 2.' % argv[0])
+        return 1
+    # one seat per keypad device (or a single seat for the keyboard).
+    nseats = max(1, len(devices))
+    ncols = min(nseats, 2)
+    nrows = (nseats+ncols-1)//ncols
+    mode = (mode[0]*ncols, mode[1]*nrows)
     #
     pygame.mixer.pre_init(22050, -16, 1)
     pygame.init()
     modes = pygame.display.list_modes()
     if mode not in modes:
         mode = modes[0]
-    pygame.display.set_mode(mode, flags)
+    display = pygame.display.set_mode(mode, flags)
     pygame.mouse.set_visible(0)
     pygame.key.set_repeat()
     font = pygame.font.Font(fontpath, 64)
@@ -709,10 +1030,38 @@ def main(argv):
     for name in SOUNDS:
         path = os.path.join(sounddir, name+'.wav')
         sounds[name] = pygame.mixer.Sound(path)
+    shared = Shared(font, sounds)
     #
-    app = App(pygame.display.get_surface(), font, sounds, args)
-    app.init('@#./.../#=!/..%/E..')
-    app.poll()
-    return app.run()
+    (w,h) = (mode[0]//ncols, mode[1]//nrows)
+    keymap = KEYCODE2SYM
+    if devices:
+        keymap = EVDEV_KEYCODE2SYM
+    apps = []
+    for seat in range(nseats):
+        logfp = None
+        if logpath is not None:
+            if 1 < nseats:
+                logfp = open('%s.%d' % (logpath, seat), 'a', 1)
+            else:
+                logfp = open(logpath, 'a', 1)
+        (x,y) = ((seat % ncols)*w, (seat // ncols)*h)
+        surface = display.subsurface((x, y, w, h))
+        if outputs:
+            channel = SeatOutput(shared, outputs[seat])
+        else:
+            channel = pygame.mixer.Channel(seat)
+        app = App(surface, shared, args, channel,
+                  logfp=logfp, keymap=keymap, timeout=timeout)
+        app.init(PLACEHOLDER_BOARD)
+        app.poll()
+        apps.append(app)
+    for (seat, path) in enumerate(devices):
+        device = evdev.InputDevice(path)
+        # keep the keypad away from the other seats.
+        device.grab()
+        thread = threading.Thread(target=read_seat, args=(seat, device))
+        thread.daemon = True
+        thread.start()
+    return run(apps, keyboard=not devices)
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+##
+##  pybotstats.py
+##
+##  Term-level statistics over pybot session logs (pybot.py -l).
+##  Requires Python2/3 + NumPy.
+##
+
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# event kinds.
+EV_SESSION = 0
+EV_LEVEL = 1
+EV_RUN = 2
+EV_CLEAR = 3
+EV_BOMB = 4
+EV_UNDO = 5
+
+# log message prefix -> (event kind, has argument).
+PREFIX2EVENT = (
+    (b'loadBoard: ', EV_LEVEL, True),
+    (b'run: ', EV_RUN, True),
+    (b'clearLevel: ', EV_CLEAR, True),
+    (b'bomb: ', EV_BOMB, True),
+    (b'undo: ', EV_UNDO, False),
+)
+
+# the placeholder board that pybot.py main() loads before polling.
+# keep in sync with pybot.PLACEHOLDER_BOARD (logged as its repr).
+PLACEHOLDER = repr('@#./.../#=!/..%/E..')
+
+# read logs in chunks of this many bytes.
+CHUNK = 1<<24
+# max width of a timestamp.
+TIMEWIDTH = 24
+PAD = b'\0'*TIMEWIDTH
+
+
+class Intern:
+
+    """Maps each distinct string to a small integer."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        return
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, s):
+        try:
+            return self.ids[s]
+        except KeyError:
+            i = self.ids[s] = len(self.names)
+            self.names.append(s)
+            return i
+
+
+class EventLog:
+
+    """Columnar store of session events.
+
+    Every event is one row over the columns time/kind/arg. Arguments
+    (boards, programs, tile positions) are interned so that only
+    distinct values become Python objects. Each file starts with
+    an EV_SESSION row.
+    """
+
+    def __init__(self):
+        self.args = Intern()
+        self._chunks = []
+        return
+
+    def read(self, fp):
+        """Reads a log opened in binary mode."""
+        self._chunks.append((numpy.zeros(1),
+                             numpy.array([EV_SESSION], dtype=numpy.int8),
+                             numpy.array([-1], dtype=numpy.int32)))
+        rest = b''
+        while 1:
+            data = fp.read(CHUNK)
+            if not data:
+                if rest:
+                    self._parse(rest+b'\n')
+                break
+            data = rest+data
+            i = data.rfind(b'\n')+1
+            rest = data[i:]
+            if i:
+                self._parse(data[:i])
+        return
+
+    def _parse(self, data):
+        # Tokenizes whole lines ("time<TAB>message<LF>") at once.
+        buf = numpy.frombuffer(data+PAD, dtype=numpy.uint8)
+        n = len(data)
+        ends = numpy.flatnonzero(buf[:n] == 10)
+        starts = numpy.concatenate(([0], ends[:-1]+1))
+        tabs = numpy.flatnonzero(buf[:n] == 9)
+        if not len(tabs): return
+        j = numpy.searchsorted(tabs, starts)
+        tab = tabs[numpy.minimum(j, len(tabs)-1)]
+        ok = (j < len(tabs)) & (tab < ends) & (tab-starts < TIMEWIDTH)
+        (starts, ends, tab) = (starts[ok], ends[ok], tab[ok])
+        # find the event lines by their message prefix.
+        kind = numpy.zeros(len(starts), dtype=numpy.int8)
+        argpos = numpy.zeros(len(starts), dtype=numpy.int64)
+        first = buf[tab+1]
+        for (prefix, ev, hasarg) in PREFIX2EVENT:
+            p = numpy.frombuffer(prefix, dtype=numpy.uint8)
+            cand = numpy.flatnonzero(first == p[0])
+            idx = numpy.minimum(tab[cand,None]+1+numpy.arange(len(p)), len(buf)-1)
+            hit = cand[(buf[idx] == p).all(axis=1)]
+            kind[hit] = ev
+            argpos[hit] = tab[hit]+1+len(p) if hasarg else -1
+        sel = numpy.flatnonzero(kind)
+        if not len(sel): return
+        (starts, ends, tab, kind, argpos) = (
+            starts[sel], ends[sel], tab[sel], kind[sel], argpos[sel])
+        # timestamps: NUL-padded fixed-width strings, parsed by NumPy.
+        w = numpy.arange(TIMEWIDTH)
+        chars = buf[starts[:,None]+w]
+        chars[tab[:,None]-starts[:,None] <= w] = 0
+        time = chars.view('S%d' % TIMEWIDTH).ravel().astype(numpy.float64)
+        # arguments: only the distinct ones are decoded and interned.
+        arg = numpy.full(len(kind), -1, dtype=numpy.int32)
+        has = numpy.flatnonzero(0 <= argpos)
+        if len(has):
+            a1 = ends[has]
+            a1 = a1 - (buf[a1-1] == 13)
+            spans = [ data[i:j] for (i,j) in zip(argpos[has].tolist(), a1.tolist()) ]
+            ids = {}
+            get = self.args.get
+            for s in dict.fromkeys(spans):
+                ids[s] = get(s.decode('utf-8', 'replace'))
+            arg[has] = numpy.fromiter(map(ids.__getitem__, spans),
+                                      dtype=numpy.int32, count=len(spans))
+        self._chunks.append((time, kind, arg))
+        return
+
+    def columns(self):
+        """Returns the time/kind/level/arg columns. Events outside
+        of a level (or on the placeholder board) have level -1."""
+        if not self._chunks:
+            return (numpy.zeros(0), numpy.zeros(0, dtype=numpy.int8),
+                    numpy.zeros(0, dtype=numpy.int32),
+                    numpy.zeros(0, dtype=numpy.int32))
+        (time, kind, arg) = [ numpy.concatenate(c) for c in zip(*self._chunks) ]
+        owner = last_index((kind == EV_LEVEL) | (kind == EV_SESSION))
+        level = numpy.where(kind[owner] == EV_LEVEL, arg[owner], -1)
+        level[level == self.args.ids.get(PLACEHOLDER, -1)] = -1
+        return (time, kind, level, arg)
+
+
+def last_index(mask):
+    """For every row, returns the index of the last row at or before it
+    where mask holds (-1 if none)."""
+    idx = numpy.where(mask, numpy.arange(len(mask)), -1)
+    return numpy.maximum.accumulate(idx)
+
+def count_pairs(a, b, nb):
+    """Counts distinct (a,b) pairs, most frequent first."""
+    (keys, counts) = numpy.unique(a.astype(numpy.int64)*nb + b,
+                                  return_counts=True)
+    order = numpy.argsort(-counts, kind='stable')
+    return [ (int(k // nb), int(k % nb), int(n)) for (k,n)
+             in zip(keys[order], counts[order]) ]
+
+
+class Stats:
+
+    def __init__(self, events):
+        self.events = events
+        (self.t, self.kind, self.level, self.arg) = events.columns()
+        self.nargs = max(1, len(events.args))
+        self.levels = numpy.unique(self.level[0 <= self.level])
+        return
+
+    def solveTimes(self):
+        """Returns (level, count, median, mean) of the time between
+        loading a level and its first clear.
+        Stepping to the goal with '+' does not count as a solve."""
+        (t, kind, level) = (self.t, self.kind, self.level)
+        start = last_index((kind == EV_LEVEL) | (kind == EV_SESSION))
+        running = self.events.args.ids.get('True', -1)
+        clear = numpy.nonzero((kind == EV_CLEAR) & (self.arg == running) &
+                              (0 <= level))[0]
+        # only the first clear after each load counts.
+        (_, first) = numpy.unique(start[clear], return_index=True)
+        clear = clear[first]
+        dt = t[clear] - t[start[clear]]
+        lv = level[clear]
+        order = numpy.argsort(lv, kind='stable')
+        (lv, dt) = (lv[order], dt[order])
+        (levels, begin) = numpy.unique(lv, return_index=True)
+        result = []
+        for (l, part) in zip(levels, numpy.split(dt, begin[1:])):
+            result.append((int(l), len(part),
+                           float(numpy.median(part)), float(part.mean())))
+        return result
+
+    def wrongPrograms(self, n=10):
+        """Returns (level, program, count) of runs which did not reach
+        the goal while running (stepping to it afterwards does not count)."""
+        kind = self.kind
+        owner = last_index((kind == EV_RUN) | (kind == EV_LEVEL) |
+                           (kind == EV_SESSION))
+        running = self.events.args.ids.get('True', -1)
+        clear = numpy.nonzero((kind == EV_CLEAR) & (self.arg == running))[0]
+        solved = numpy.zeros(len(kind), dtype=bool)
+        solved[owner[clear]] = True
+        wrong = numpy.nonzero((kind == EV_RUN) & ~solved & (0 <= self.level))[0]
+        return count_pairs(self.level[wrong], self.arg[wrong], self.nargs)[:n]
+
+    def bombTiles(self, n=10):
+        """Returns (level, tile, count) of bomb resets."""
+        bomb = numpy.nonzero((self.kind == EV_BOMB) & (0 <= self.level))[0]
+        return count_pairs(self.level[bomb], self.arg[bomb], self.nargs)[:n]
+
+    def undoUsage(self):
+        """Returns (level, undos, runs) for each level."""
+        kind = self.kind
+        level = self.level
+        valid = 0 <= level
+        undos = numpy.bincount(level[valid & (kind == EV_UNDO)], minlength=self.nargs)
+        runs = numpy.bincount(level[valid & (kind == EV_RUN)], minlength=self.nargs)
+        return [ (int(l), int(undos[l]), int(runs[l])) for l in self.levels ]
+
+    def report(self, out=sys.stdout, n=10):
+        levels = args = self.events.args.names
+        out.write('events: %d, levels: %d\n' % (len(self.kind), len(self.levels)))
+        out.write('\n# time to solve\n')
+        for (l, count, median, mean) in self.solveTimes():
+            out.write('%s: solved=%d, median=%.1fs, mean=%.1fs\n' %
+                      (levels[l], count, median, mean))
+        out.write('\n# wrong programs\n')
+        for (l, a, count) in self.wrongPrograms(n):
+            out.write('%s: %s x%d\n' % (levels[l], args[a], count))
+        out.write('\n# bomb resets\n')
+        for (l, a, count) in self.bombTiles(n):
+            out.write('%s: %s x%d\n' % (levels[l], args[a], count))
+        out.write('\n# undo\n')
+        for (l, undos, runs) in self.undoUsage():
+            out.write('%s: undo=%d, runs=%d\n' % (levels[l], undos, runs))
+        return
+
+
+def main(argv):
+    import getopt
+    def usage():
+        print('usage: %s [-n top] logfile ...' % argv[0])
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'n:')
+    except getopt.GetoptError:
+        return usage()
+    n = 10
+    for (k, v) in opts:
+        if k == '-n': n = int(v)
+    if not args: return usage()
+    if numpy is None:
+        print('%s: numpy is required.' % argv[0])
+        return 1
+    #
+    events = EventLog()
+    for path in args:
+        fp = open(path, 'rb')
+        events.read(fp)
+        fp.close()
+    Stats(events).report(n=n)
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))